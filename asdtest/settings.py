@@ -128,6 +128,9 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'upload')
 
 FILEBOX_MAX_FILES_PER_USER = 100
 
+# Files up to this size (in bytes) are stored in the database instead of MEDIA_ROOT
+FILEBOX_INLINE_MAX_SIZE = 1024
+
 
 LOGGING = {
     'version': 1,
@@ -2,6 +2,7 @@
 
 from django.forms import Form, FileField
 from django.core.exceptions import ValidationError
+from django.contrib.auth.models import User
 from django.conf import settings
 
 from filebox.models import FileMetaData
@@ -16,6 +17,8 @@ class FileUploadForm(Form):
         self.user = user
 
     def clean(self):
+        # must be called inside transaction.atomic(), so that the user stays locked until save()
+        User.objects.select_for_update().get(pk=self.user.pk)
         n_files = FileMetaData.objects.filter(user=self.user).count()
         if n_files >= settings.FILEBOX_MAX_FILES_PER_USER:
             raise ValidationError(
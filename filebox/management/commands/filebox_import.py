@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.files import File
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import six
+from django.utils.encoding import force_text, DjangoUnicodeDecodeError
+from django.conf import settings
+
+import filebox.models
+from filebox.models import FileMetaData, FileContent
+
+logger = logging.getLogger('filebox.import')
+
+# keeps `sha1__in` lookups well below SQLite's limit of 999 bound parameters
+SHA1_LOOKUP_CHUNK = 500
+
+
+def _hash_path(path):
+    # hashlib releases the GIL while hashing, so threads are enough here
+    with open(path, 'rb') as f:
+        return path, os.path.getsize(path), filebox.models._sha1_of_file(File(f))
+
+
+def _same_content(filecontent, path):
+    with open(path, 'rb') as f:
+        for chunk in filecontent.chunks():
+            if f.read(len(chunk)) != chunk:
+                return False
+        return f.read(1) == b''
+
+
+class Command(BaseCommand):
+    help = 'Imports all files from a directory tree into the filebox of given user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('path')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Number of threads used for hashing files')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of files deduplicated and inserted per transaction')
+        parser.add_argument('--link', action='store_true', default=False,
+                            help='Hardlink files into storage instead of copying when possible. '
+                                 'Stored content then shares its inode with the source file, so '
+                                 'later edits of the source silently change the stored content')
+
+    def handle(self, *args, **options):
+        for option in ('workers', 'batch_size'):
+            if options[option] < 1:
+                raise CommandError(u'--{0} must be at least 1'.format(option.replace('_', '-')))
+
+        # command line arguments are byte strings on Python 2
+        encoding = sys.getfilesystemencoding()
+        try:
+            username = force_text(options['username'], encoding=encoding)
+            root = force_text(options['path'], encoding=encoding)
+        except DjangoUnicodeDecodeError:
+            raise CommandError(u'Arguments are not valid in filesystem encoding {0}'.format(encoding))
+
+        try:
+            user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError(u'User "{0}" does not exist'.format(username))
+
+        if not os.path.isdir(root):
+            raise CommandError(u'"{0}" is not a directory'.format(root))
+
+        # walking a unicode root yields unicode names, except for the ones that can't be decoded
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in dirnames + filenames:
+                if not isinstance(name, six.text_type):
+                    self.stderr.write(u'Skipping {0!r} in "{1}": name is not valid in filesystem encoding {2}'.format(
+                        name, dirpath, encoding
+                    ))
+            dirnames[:] = sorted(name for name in dirnames if isinstance(name, six.text_type))
+            for filename in sorted(filenames):
+                if not isinstance(filename, six.text_type):
+                    continue
+                path = os.path.join(dirpath, filename)
+                if os.path.isfile(path):
+                    paths.append(path)
+
+        self.check_quota(user, len(paths))
+
+        self.link = options['link']
+        self.field = FileContent._meta.get_field('content')
+
+        started = time.time()
+        imported = 0
+        imported_bytes = 0
+        batch_size = options['batch_size']
+
+        pool = ThreadPool(options['workers'])
+        try:
+            for start in range(0, len(paths), batch_size):
+                batch = pool.map(_hash_path, paths[start : start + batch_size])
+                self.import_batch(user, batch)
+
+                imported += len(batch)
+                imported_bytes += sum(size for path, size, sha1 in batch)
+                elapsed = max(time.time() - started, 1e-6)
+                self.stdout.write(u'Imported {0}/{1} files ({2:.1f} files/s, {3:.2f} MB/s)'.format(
+                    imported, len(paths), imported / elapsed, imported_bytes / elapsed / 2**20
+                ))
+        finally:
+            pool.close()
+            pool.join()
+
+        logger.info('Imported %(n)s files from "%(path)s" for user "%(user)s"',
+                    { 'n': imported, 'path': root, 'user': user })
+
+    def check_quota(self, user, n_new):
+        n_files = FileMetaData.objects.filter(user=user).count()
+        if n_files + n_new > settings.FILEBOX_MAX_FILES_PER_USER:
+            raise CommandError(
+                u'Cannot import {0} files: user "{1}" already has {2} files, limit is {3}'.format(
+                    n_new, user, n_files, settings.FILEBOX_MAX_FILES_PER_USER
+                )
+            )
+
+    def import_batch(self, user, batch):
+        by_sha1 = defaultdict(list)
+        for path, size, sha1 in batch:
+            by_sha1[sha1].append((path, size))
+        sha1s = list(by_sha1)
+
+        stored = []
+        created = []
+        try:
+            with transaction.atomic():
+                # same lock as FileUploadForm takes, serializing imports and uploads for the same user
+                User.objects.select_for_update().get(pk=user.pk)
+                self.check_quota(user, len(batch))
+
+                # candidates are locked where the backend supports it (not on SQLite), so refcounts
+                # are still changed only through incref(), which copes with concurrent deletes
+                existing = defaultdict(list)
+                for start in range(0, len(sha1s), SHA1_LOOKUP_CHUNK):
+                    chunk = sha1s[start : start + SHA1_LOOKUP_CHUNK]
+                    for filecontent in FileContent.objects.select_for_update().filter(sha1__in=chunk):
+                        existing[filecontent.sha1].append(filecontent)
+
+                metadata = []
+                for sha1, files in by_sha1.items():
+                    # (filecontent, paths referencing it) for every distinct content
+                    groups = []
+                    for path, size in files:
+                        for group in groups:
+                            if group[0].size == size and _same_content(group[0], path):
+                                group[1].append(path)
+                                break
+                        else:
+                            filecontent = self.find_existing(existing[sha1], path, size)
+                            if filecontent is None:
+                                filecontent = self.new_content(path, size, sha1, stored)
+                            groups.append((filecontent, [path]))
+
+                    for filecontent, group_paths in groups:
+                        is_new = filecontent.pk is None
+                        if not is_new:
+                            try:
+                                filecontent.incref(len(group_paths))
+                            except FileContent.DoesNotExist:
+                                # deleted by a concurrent decref() since it was fetched
+                                path = group_paths[0]
+                                filecontent = self.new_content(path, os.path.getsize(path), sha1, stored)
+                                is_new = True
+                        if is_new:
+                            filecontent.refcount = len(group_paths)
+                            filecontent.save()
+                        for i, path in enumerate(group_paths):
+                            md = FileMetaData(user=user, filename=os.path.basename(path), content=filecontent)
+                            metadata.append(md)
+                            created.append((md, is_new and i == 0))
+
+                FileMetaData.objects.bulk_create(metadata)
+        except Exception:
+            for name in stored:
+                self.field.storage.delete(name)
+            raise
+
+        # bulk_create() doesn't send post_save, so logging the same lines as on_filemetadata_create here
+        for md, adds_content in created:
+            if adds_content:
+                log_msg = 'User "%(user)s" uploaded file "%(filename)s", adding new filecontent %(filecontent)s'
+            else:
+                log_msg = 'User "%(user)s" uploaded file "%(filename)s", referencing already existing filecontent %(filecontent)s'
+            logger.info(log_msg, {'user': md.user, 'filename': md.filename, 'filecontent': md.content })
+
+    def new_content(self, path, size, sha1, stored):
+        if size <= settings.FILEBOX_INLINE_MAX_SIZE:
+            with open(path, 'rb') as f:
+                return FileContent(inline=f.read(), sha1=sha1, refcount=0)
+
+        filecontent = FileContent(content=self.store(path), sha1=sha1, refcount=0)
+        stored.append(filecontent.content.name)
+        return filecontent
+
+    def find_existing(self, candidates, path, size):
+        for filecontent in candidates:
+            if filecontent.size == size and _same_content(filecontent, path):
+                return filecontent
+        return None
+
+    def store(self, path):
+        name = self.field.generate_filename(None, os.path.basename(path))
+        storage = self.field.storage
+
+        if self.link:
+            try:
+                name = storage.get_available_name(name)
+                # os.link() would link a symlink itself rather than its target
+                os.link(os.path.realpath(path), storage.path(name))
+                return name
+            except (NotImplementedError, OSError):
+                pass
+
+        with open(path, 'rb') as f:
+            return storage.save(name, File(f))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileContent',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('content', models.FileField(upload_to='')),
+                ('sha1', models.CharField(max_length=40, db_index=True)),
+                ('refcount', models.IntegerField(default=1)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FileMetaData',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('filename', models.CharField(max_length=256)),
+                ('uploaded_at', models.DateTimeField(auto_now_add=True, null=True)),
+                ('content', models.ForeignKey(to='filebox.FileContent')),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-uploaded_at'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='filemetadata',
+            index_together=set([('user', 'uploaded_at')]),
+        ),
+    ]
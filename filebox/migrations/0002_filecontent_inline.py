@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('filebox', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filecontent',
+            name='inline',
+            field=models.BinaryField(null=True, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='filecontent',
+            name='content',
+            field=models.FileField(upload_to='', blank=True),
+        ),
+    ]
@@ -1,7 +1,10 @@
 import hashlib
 import logging
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
+from django.conf import settings
+from django.core.files.base import ContentFile
 from django.contrib.auth.models import User
 from django.db.models.signals import pre_delete, post_delete, post_save
 from django.dispatch import receiver
@@ -25,38 +28,72 @@ class FileContentManager(models.Manager):
         content = file.read()
 
         for existing in self.model.objects.filter(sha1=sha1):
-            if existing.content.size != file.size:
+            if existing.size != file.size:
                 continue
 
             equals = True
             pos = 0
-            for chunk in existing.content.chunks():
+            for chunk in existing.chunks():
                 if chunk != content[pos : pos + len(chunk)]:
                     equals = False
                     break
                 pos += len(chunk)
 
             if equals:
-                existing.incref()
+                try:
+                    existing.incref()
+                except self.model.DoesNotExist:
+                    # deleted by a concurrent decref() since it was fetched
+                    continue
                 return existing
 
+        if file.size <= settings.FILEBOX_INLINE_MAX_SIZE:
+            return self.create(inline=content, sha1=sha1, refcount=1)
         return self.create(content=file, sha1=sha1, refcount=1)
 
 
 class FileContent(models.Model):
     objects = FileContentManager()
 
-    content = models.FileField()
+    content = models.FileField(blank=True)
+    # content not larger than FILEBOX_INLINE_MAX_SIZE is kept here instead of `content`
+    inline = models.BinaryField(null=True, blank=True)
     sha1 = models.CharField(max_length=40, db_index=True)
     refcount = models.IntegerField(default=1)
 
     def __unicode__(self):
-        return u'{0} ({1} bytes, refs={2})'.format(self.sha1[:10], self.content.size, self.refcount)
+        return u'{0} ({1} bytes, refs={2})'.format(self.sha1[:10], self.size, self.refcount)
+
+    @property
+    def size(self):
+        if self.inline is not None:
+            return len(self.inline)
+        return self.content.size
+
+    def chunks(self):
+        if self.inline is not None:
+            yield bytes(self.inline)
+        else:
+            try:
+                for chunk in self.content.chunks():
+                    yield chunk
+            finally:
+                self.content.close()
+
+    def read(self):
+        return b''.join(self.chunks())
 
     def incref(self, nrefs=1, commit=True):
+        """
+        Raises DoesNotExist if filecontent was deleted in the meantime
+        """
         self.refcount += nrefs
         if commit:
-            self.save(update_fields=['refcount'])
+            # F() update instead of save() so that concurrent increfs/decrefs are not lost
+            with transaction.atomic():
+                if not FileContent.objects.filter(pk=self.pk).update(refcount=F('refcount') + nrefs):
+                    raise FileContent.DoesNotExist()
+                self.refresh_from_db(fields=['refcount'])
 
     def decref(self, nrefs=1, commit=True):
         """
@@ -64,18 +101,26 @@ class FileContent(models.Model):
         Returns False if filecontent has more references to it
         """
         self.refcount -= nrefs
-        if self.refcount > 0:
-            if commit:
-                self.save(update_fields=['refcount'])
+        if not commit:
             return False
-        else:
-            self.content.delete()
-            self.delete()
+
+        with transaction.atomic():
+            FileContent.objects.filter(pk=self.pk).update(refcount=F('refcount') - nrefs)
+            # row is write-locked by the update above, so nobody can incref it before it's deleted
+            self.refresh_from_db(fields=['refcount'])
+            if self.refcount > 0:
+                return False
+            FileContent.objects.filter(pk=self.pk, refcount__lte=0).delete()
+            if self.content:
+                self.content.delete()
             return True
 
     def save(self, *args, **kwargs):
         if not self.sha1:
-            self.sha1 = _sha1_of_file(self.content)
+            if self.inline is not None:
+                self.sha1 = _sha1_of_file(ContentFile(bytes(self.inline)))
+            else:
+                self.sha1 = _sha1_of_file(self.content)
         return super(FileContent, self).save(*args, **kwargs)
 
 
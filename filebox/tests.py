@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import os
+import shutil
+import sys
+import tempfile
+
 from django.test import TestCase, override_settings
 from django.core.files.base import ContentFile
 from django.contrib.auth.models import User
 from django.contrib.messages.storage.base import Message
 from django.contrib.messages.constants import INFO, SUCCESS
+from django.db.models import F
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils.six import StringIO
 from django.conf import settings
 
 import filebox.models
+import filebox.management.commands.filebox_import as filebox_import
 from filebox.models import FileMetaData, FileContent
 
 class TestFileContent(TestCase):
@@ -54,6 +64,30 @@ class TestFileContent(TestCase):
         finally:
             filebox.models._sha1_of_file = original
 
+    def test_inline(self):
+        md = FileMetaData.objects.create_with_content(
+            contentfile=ContentFile('Hello, World!', name='test.txt'), user=self.user, filename='test.txt'
+        )
+        self.assertEqual(bytes(md.content.inline), 'Hello, World!')
+        self.assertFalse(md.content.content)
+
+        md.delete()
+        self.assertEqual(FileContent.objects.count(), 0)
+
+    @override_settings(FILEBOX_INLINE_MAX_SIZE=4)
+    def test_not_inline(self):
+        args = { 'contentfile': ContentFile('Hello, World!', name='test.txt'), 'user': self.user }
+        md1 = FileMetaData.objects.create_with_content(filename='file1', **args)
+        md2 = FileMetaData.objects.create_with_content(filename='file2', **args)
+
+        self.assertEqual(md1.content, md2.content)
+        self.assertIsNone(md1.content.inline)
+        self.assertEqual(md1.content.content.read(), 'Hello, World!')
+
+        name = md1.content.content.name
+        FileMetaData.objects.all().delete()
+        self.assertFalse(md1.content.content.storage.exists(name))
+
 
 class TestFileList(TestCase):
 
@@ -114,7 +148,7 @@ class TestUploadForm(TestCase):
         self.assertEqual(md.filename, self.testcontent.name)
 
         self.testcontent.seek(0)
-        self.assertEqual(md.content.content.read(), self.testcontent.read())
+        self.assertEqual(md.content.read(), self.testcontent.read())
 
     def test_empty(self):
         response = self.client.post('/upload')
@@ -206,5 +240,177 @@ class TestDownloadFile(TestCase):
     def test_download(self):
         response = self.client.get('/download/{0}/test.txt'.format(self.file1.id))
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.content, self.file1.content.content.read())
+        self.assertEqual(response.content, self.file1.content.read())
         self.assertEqual(response['Content-Disposition'], 'attachment; filename="test.txt"')
+
+    @override_settings(FILEBOX_INLINE_MAX_SIZE=4)
+    def test_download_from_storage(self):
+        md = FileMetaData.objects.create_with_content(
+            contentfile=ContentFile('Hello from storage', name='big.txt'),
+            filename='big.txt',
+            user=self.vasya
+        )
+        response = self.client.get('/download/{0}/big.txt'.format(md.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, 'Hello from storage')
+        md.delete()
+
+
+class TestImportCommand(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.vasya = User.objects.create_user(username='vasya', password='vasya')
+        cls.petya = User.objects.create_user(username='petya', password='petya')
+        cls.existing = FileMetaData.objects.create_with_content(
+            contentfile=ContentFile('Hello, World!', name='test.txt'),
+            filename='test.txt',
+            user=cls.petya
+        )
+
+    def setUp(self):
+        # on the same filesystem as the storage, so that --link can hardlink
+        self.root = tempfile.mkdtemp(dir=settings.MEDIA_ROOT)
+        os.mkdir(os.path.join(self.root, 'sub'))
+        for name, data in [('a.txt', 'Hello, World!'), ('b.txt', 'Other'), ('sub/c.txt', 'Other')]:
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_import(self):
+        out = StringIO()
+        call_command('filebox_import', 'vasya', self.root, batch_size=2, stdout=out)
+        self.assertIn('Imported 3/3 files', out.getvalue())
+
+        self.assertEqual(
+            sorted(FileMetaData.objects.filter(user=self.vasya).values_list('filename', flat=True)),
+            ['a.txt', 'b.txt', 'c.txt']
+        )
+        self.assertEqual(FileContent.objects.count(), 2)
+        self.assertEqual(FileContent.objects.get(pk=self.existing.content.pk).refcount, 2)
+
+        other = FileMetaData.objects.get(user=self.vasya, filename='b.txt').content
+        self.assertEqual(other.refcount, 2)
+        self.assertEqual(other.read(), 'Other')
+
+        FileMetaData.objects.filter(user=self.vasya).delete()
+        self.assertEqual(FileContent.objects.count(), 1)
+
+    def test_maxfiles(self):
+        n_files = settings.FILEBOX_MAX_FILES_PER_USER - 2
+        FileMetaData.objects.bulk_create(
+            [FileMetaData(user=self.vasya, filename='test.txt', content=self.existing.content) for i in range(n_files)]
+        )
+        FileContent.objects.filter(pk=self.existing.content.pk).update(refcount=F('refcount') + n_files)
+
+        with self.assertRaises(CommandError):
+            call_command('filebox_import', 'vasya', self.root, stdout=StringIO())
+        self.assertEqual(FileMetaData.objects.filter(user=self.vasya).count(), n_files)
+        self.assertEqual(FileContent.objects.get(pk=self.existing.content.pk).refcount, n_files + 1)
+
+    def test_invalid_options(self):
+        for options in ({'workers': 0}, {'batch_size': 0}):
+            with self.assertRaises(CommandError):
+                call_command('filebox_import', 'vasya', self.root, stdout=StringIO(), **options)
+
+    @override_settings(FILEBOX_INLINE_MAX_SIZE=4)
+    def test_import_to_storage(self):
+        call_command('filebox_import', 'vasya', self.root, batch_size=2, stdout=StringIO())
+
+        other = FileMetaData.objects.get(user=self.vasya, filename='b.txt').content
+        self.assertEqual(FileMetaData.objects.get(user=self.vasya, filename='c.txt').content, other)
+        self.assertEqual(other.refcount, 2)
+        self.assertIsNone(other.inline)
+        self.assertEqual(other.content.read(), 'Other')
+        self.assertNotEqual(os.stat(other.content.path).st_ino, os.stat(os.path.join(self.root, 'b.txt')).st_ino)
+
+        name = other.content.name
+        FileMetaData.objects.filter(user=self.vasya).delete()
+        self.assertFalse(other.content.storage.exists(name))
+
+    @override_settings(FILEBOX_INLINE_MAX_SIZE=4)
+    def test_import_link(self):
+        call_command('filebox_import', 'vasya', self.root, link=True, stdout=StringIO())
+
+        other = FileMetaData.objects.get(user=self.vasya, filename='b.txt').content
+        self.assertEqual(os.stat(other.content.path).st_ino, os.stat(os.path.join(self.root, 'b.txt')).st_ino)
+
+        FileMetaData.objects.filter(user=self.vasya).delete()
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'b.txt')))
+
+    @override_settings(FILEBOX_INLINE_MAX_SIZE=4)
+    def test_import_failure_cleans_storage(self):
+        storage = FileContent._meta.get_field('content').storage
+        files_before = set(storage.listdir('')[1])
+
+        def fail(objs):
+            raise RuntimeError('bulk_create failed')
+
+        FileMetaData.objects.bulk_create = fail
+        try:
+            with self.assertRaises(RuntimeError):
+                call_command('filebox_import', 'vasya', self.root, stdout=StringIO())
+        finally:
+            del FileMetaData.objects.bulk_create
+
+        self.assertEqual(set(storage.listdir('')[1]), files_before)
+        self.assertEqual(FileContent.objects.count(), 1)
+        self.assertEqual(FileMetaData.objects.filter(user=self.vasya).count(), 0)
+
+    def import_with_concurrent_change(self, change):
+        # runs `change` once, after the importer has read the candidates but before it has written anything
+        original = filebox_import._same_content
+        def same_content(filecontent, path):
+            if change:
+                change.pop()()
+            return original(filecontent, path)
+
+        change = [change]
+        filebox_import._same_content = same_content
+        try:
+            call_command('filebox_import', 'vasya', self.root, stdout=StringIO())
+        finally:
+            filebox_import._same_content = original
+
+    def test_concurrent_upload(self):
+        self.import_with_concurrent_change(lambda: FileMetaData.objects.create_with_content(
+            contentfile=ContentFile('Hello, World!', name='test.txt'), filename='test.txt', user=self.petya
+        ))
+
+        self.assertEqual(FileContent.objects.get(pk=self.existing.content.pk).refcount, 3)
+        self.assertEqual(FileMetaData.objects.filter(content=self.existing.content).count(), 3)
+
+    def test_concurrent_delete(self):
+        self.import_with_concurrent_change(lambda: FileMetaData.objects.filter(pk=self.existing.pk).delete())
+
+        self.assertFalse(FileContent.objects.filter(pk=self.existing.content.pk).exists())
+        md = FileMetaData.objects.get(user=self.vasya, filename='a.txt')
+        self.assertEqual(md.content.refcount, 1)
+        self.assertEqual(md.content.read(), 'Hello, World!')
+
+    def test_non_ascii_arguments(self):
+        # arguments arrive as byte strings in filesystem encoding, like from the command line on Python 2
+        encoding = sys.getfilesystemencoding()
+        try:
+            username = u'вася'.encode(encoding)
+            u'файл.txt'.encode(encoding)
+        except UnicodeEncodeError:
+            self.skipTest('filesystem encoding {0} cannot encode non-ASCII names'.format(encoding))
+        root = os.path.join(self.root, 'sub')
+        if not isinstance(root, bytes):
+            root = root.encode(encoding)
+
+        User.objects.create_user(u'вася', password='vasya')
+        with open(os.path.join(self.root, 'sub', u'файл.txt'), 'wb') as f:
+            f.write('Файл')
+
+        call_command('filebox_import', username, root, stdout=StringIO())
+        self.assertEqual(
+            sorted(FileMetaData.objects.filter(user__username=u'вася').values_list('filename', flat=True)),
+            [u'c.txt', u'файл.txt']
+        )
+
+        with self.assertRaises(CommandError):
+            call_command('filebox_import', u'петя'.encode(encoding), root, stdout=StringIO())
@@ -11,6 +11,8 @@ from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse
 from django.core.servers.basehttp import FileWrapper
 from django.contrib import messages
+from django.db import transaction
+from django.utils.decorators import method_decorator
 
 from filebox.models import FileMetaData
 from filebox.forms import FileUploadForm
@@ -37,6 +39,11 @@ class FileUploadView(LoginRequiredMixin, FormView):
     def get_form(self):
         return FileUploadForm(self.request.user, **self.get_form_kwargs())
 
+    # FileUploadForm's quota check and save() have to share one transaction
+    @method_decorator(transaction.atomic)
+    def post(self, *args, **kwargs):
+        return super(FileUploadView, self).post(*args, **kwargs)
+
     def form_valid(self, form):
         saved = form.save()
         if saved.content.refcount > 1:
@@ -71,6 +78,11 @@ class FileDownloadView(SingleObjectMixin, View):
 
         logger.info('Downloading file %(md)s, %(fc)s', { 'md': filemetadata, 'fc': filemetadata.content })
 
-        response = HttpResponse(FileWrapper(filemetadata.content.content), content_type='application/octet-stream')
+        if filemetadata.content.inline is not None:
+            body = bytes(filemetadata.content.inline)
+        else:
+            body = FileWrapper(filemetadata.content.content)
+
+        response = HttpResponse(body, content_type='application/octet-stream')
         response['Content-Disposition'] = u'attachment; filename="{0}"'.format(filemetadata.filename)
         return response